@@ -16,11 +16,16 @@
 
 # COMMAND ----------
 
-# MAGIC %pip install bamboolib
+dbutils.widgets.dropdown("interactive", "false", ["true", "false"], "Interactive exploration")
+dbutils.widgets.dropdown("debug_stats", "false", ["true", "false"], "Compute dataset stats")
 
-# COMMAND ----------
-
-import bamboolib as bam
+# Bamboolib is only used for interactive exploration, install it as a cluster library to use it
+interactive = dbutils.widgets.get("interactive") == "true"
+if interactive:
+  try:
+    import bamboolib as bam
+  except ImportError as e:
+    raise ImportError("bamboolib is required for interactive exploration, add it as a cluster library or set the interactive widget to false") from e
 
 # COMMAND ----------
 
@@ -29,6 +34,46 @@ spark.sql(f"USE {database}")
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ### Cluster configuration
+# MAGIC 
+# MAGIC Some settings can't be changed once the cluster is started. Add them to the cluster Spark config (cluster UI or init script):
+# MAGIC 
+# MAGIC ```
+# MAGIC spark.serializer org.apache.spark.serializer.KryoSerializer
+# MAGIC spark.kryo.registrationRequired false
+# MAGIC spark.kryoserializer.buffer.max 512m
+# MAGIC ```
+# MAGIC 
+# MAGIC Kryo only affects RDD and closure serialization: the DataFrame and Delta operations of this notebook use their own serializer and aren't impacted.
+# MAGIC 
+# MAGIC Our scans are columnar and light on compute: use a Photon enabled ML runtime and keep the vectorized parquet reader on (`spark.sql.parquet.enableVectorizedReader true`, the default).
+# MAGIC 
+# MAGIC To explore the data with Bamboolib, add `bamboolib` as a cluster library and run the notebook with the `interactive` widget set to `true`.
+
+# COMMAND ----------
+
+# DBTITLE 1,Spark configuration
+print(f"Photon enabled: {spark.conf.get('spark.databricks.photon.enabled', 'false')}")
+spark.conf.set("spark.sql.parquet.enableVectorizedReader", "true")
+spark.conf.set("spark.sql.parquet.columnarReaderBatchSize", "8192")
+# Optimized writes + auto compaction to avoid small files in our feature table
+spark.conf.set("spark.databricks.delta.optimizeWrite.enabled", "true")
+spark.conf.set("spark.databricks.delta.autoCompact.enabled", "true")
+# Use arrow for our toPandas() collects (falls back to the default serialization for unsupported types)
+spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+spark.conf.set("spark.sql.execution.arrow.pyspark.fallback.enabled", "true")
+spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", "20000")
+spark.conf.set("spark.sql.execution.arrow.pyspark.selfDestruct.enabled", "true")
+# Adaptive query execution for the spark stages of this notebook
+# The first three lines restate the DBR defaults, the advisory partition size is doubled from 64MB to 128MB
+spark.conf.set("spark.sql.adaptive.enabled", "true")
+spark.conf.set("spark.sql.adaptive.skewJoin.enabled", "true")
+spark.conf.set("spark.sql.adaptive.coalescePartitions.enabled", "true")
+spark.conf.set("spark.sql.adaptive.advisoryPartitionSizeInBytes", "134217728")
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## Data exploration and analysis
 # MAGIC 
@@ -44,18 +89,50 @@ display(churn_dataset)
 # COMMAND ----------
 
 # DBTITLE 1,Data Exploration and analysis
-import seaborn as sns
-g = sns.PairGrid(churn_dataset.sample(0.01).toPandas()[['age_group','gender','order_count']], diag_sharey=False)
-g.map_lower(sns.kdeplot)
-g.map_diag(sns.kdeplot, lw=3)
-g.map_upper(sns.regplot)
+import math
+import matplotlib.pyplot as plt
+import pyspark.sql.functions as F
+# Compute the order_count histogram in spark, only the ~50 bins are sent to the driver
+nb_bins = 50
+order_count_range = churn_dataset.select(F.min('order_count').alias('min'), F.max('order_count').alias('max')).first()
+if order_count_range['min'] is None:
+  print("No order_count to plot")
+else:
+  # order_count is an integer, use integer bin widths (at least 1) so every bin covers the same number of values
+  bin_width = max(1, math.ceil((order_count_range['max'] - order_count_range['min']) / nb_bins))
+  histogram = (churn_dataset.where(F.col('order_count').isNotNull())
+                            .groupBy(F.floor((F.col('order_count') - order_count_range['min']) / bin_width).alias('bin'))
+                            .count()
+                            .orderBy('bin')
+                            .toPandas())
+  plt.bar(order_count_range['min'] + histogram['bin'] * bin_width, histogram['count'], width=bin_width, align='edge')
+  plt.xlabel('order_count')
+  plt.show()
+
+# COMMAND ----------
+
+# DBTITLE 1,order_count distribution per age_group and gender
+# Quartiles are computed in spark, we only collect one row per age_group / gender
+quartiles = (churn_dataset.groupBy('age_group', 'gender')
+                          .agg(F.percentile_approx('order_count', [0.25, 0.5, 0.75]).alias('quartiles'))
+                          .select('age_group', 'gender', F.col('quartiles')[0].alias('q1'), F.col('quartiles')[1].alias('median'), F.col('quartiles')[2].alias('q3'))
+                          .toPandas())
+# Plot the median order_count with the interquartile range as error bars
+medians = quartiles.pivot(index='age_group', columns='gender', values='median')
+lower = medians - quartiles.pivot(index='age_group', columns='gender', values='q1')
+upper = quartiles.pivot(index='age_group', columns='gender', values='q3') - medians
+medians.plot.bar(yerr=[[lower[c].values, upper[c].values] for c in medians.columns], capsize=3)
+plt.ylabel('order_count (median and interquartile range)')
+plt.show()
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ### Further data analysis and preparation using pandas API
+# MAGIC ### Further data preparation
+# MAGIC 
+# MAGIC We drop the columns we don't need and the missing values directly with spark, so they are pushed down to the Delta scan and the dropped columns are never read.
 # MAGIC 
-# MAGIC Because our Data Scientist team is familiar with Pandas, we'll use `pandas on spark` to scale `pandas` code. The Pandas instructions will be converted in the spark engine under the hood and distributed at scale.
+# MAGIC If our Data Scientist team prefers Pandas, `pandas on spark` can be used to scale `pandas` code on top of the same dataframe: the Pandas instructions are converted in the spark engine under the hood and distributed at scale.
 # MAGIC 
 # MAGIC Typicaly Data Science project would involve more advanced preparation and likely require extra data prep step, including more complex feature preparation. We'll keep it simple for this demo.
 # MAGIC 
@@ -63,20 +140,27 @@ g.map_upper(sns.regplot)
 
 # COMMAND ----------
 
-# DBTITLE 1,Custom pandas transformation / code on top of your entire dataset - KOALAS
-# Convert to koalas
-dataset = churn_dataset.pandas_api()
-dataset.describe()  
-# Drop columns we don't want to use in our model
-dataset = dataset.drop(columns=['address', 'email', 'firstname', 'lastname', 'creation_date', 'last_activity_date', 'last_event'])
-# Drop missing values
-dataset = dataset.dropna()   
+# DBTITLE 1,Feature preparation on top of your entire dataset
+# Drop columns we don't want to use in our model and missing values in spark first, so they are pushed down to the delta scan
+drop_cols = {'address', 'email', 'firstname', 'lastname', 'creation_date', 'last_activity_date', 'last_event'}
+keep_cols = [c for c in churn_dataset.columns if c not in drop_cols]
+churn_spark = churn_dataset.select(*keep_cols).na.drop()
+# describe() runs a full scan, only compute it when we want to look at the stats
+debug_stats = dbutils.widgets.get("debug_stats") == "true"
+if debug_stats:
+  # Convert to koalas
+  dataset = churn_spark.pandas_api()
+  display(dataset.describe())
 
 # COMMAND ----------
 
 # DBTITLE 1,Bamboolib - Exploration
-pdf = churn_dataset.toPandas()
-pdf
+# Only collect a preview of the columns we keep to the driver (no PII), the full table stays distributed in spark
+if interactive:
+  from IPython.display import display as ipython_display
+  pdf = churn_dataset.select(*keep_cols).limit(10000).toPandas()
+  # Use the IPython display so bamboolib renders its UI instead of the databricks table
+  ipython_display(pdf)
 
 # COMMAND ----------
 
@@ -97,25 +181,38 @@ pdf
 # COMMAND ----------
 
 from databricks.feature_store import FeatureStoreClient
+from pyspark import StorageLevel
 
 fs = FeatureStoreClient()
 
-try:
-  #drop table if exists
-  fs.drop_table(f'{database}.churn_user_features')
-except:
-  pass
-#Note: You might need to delete the FS table using the UI
-churn_feature_table = fs.create_table(
-  name=f'{database}.churn_user_features',
-  primary_keys='user_id',
-  schema=dataset.spark.schema(),
-  description='These features are derived from the churn_bronze_customers table in the lakehouse.  We created dummy variables for the categorical columns, cleaned up their names, and added a boolean flag for whether the customer churned or not.  No aggregations were performed.'
-)
+# Materialize our prepared features once, the table creation and the write both reuse it
+# We use the spark dataframe directly to avoid the pandas api index being written to the table
+prepared = churn_spark.persist(StorageLevel.MEMORY_AND_DISK)
+prepared.count()
 
-fs.write_table(df=dataset.to_spark(), name=f'{database}.churn_user_features', mode='overwrite')
-features = fs.read_table(f'{database}.churn_user_features')
-display(features)
+#Only create the table the first time it's registered in the feature store, later runs overwrite it in place instead of dropping it
+#Note: if the schema changes, you might need to delete the FS table using the UI
+try:
+  churn_feature_table = fs.get_table(f'{database}.churn_user_features')
+except Exception:
+  churn_feature_table = fs.create_table(
+    name=f'{database}.churn_user_features',
+    primary_keys='user_id',
+    schema=prepared.schema, # already resolved on the cached dataframe, no extra spark job
+    description='These features are derived from the churn_bronze_customers table in the lakehouse.  We created dummy variables for the categorical columns, cleaned up their names, and added a boolean flag for whether the customer churned or not.  No aggregations were performed.'
+  )
+#Liquid clustering on our join key (user_id) for the inference joins
+#This is idempotent, and also clusters tables created by previous runs of this notebook
+spark.sql(f"ALTER TABLE {database}.churn_user_features CLUSTER BY (user_id)")
+
+#Optimized writes (see the spark configuration above) already size the output files, no need to repartition
+#For incremental refreshes, use mode='merge' to only upsert the users that changed (keyed on user_id)
+fs.write_table(df=prepared, name=f'{database}.churn_user_features', mode='overwrite')
+prepared.unpersist()
+# Colocate the rows on user_id so the inference joins can skip more files
+# (ZORDER isn't supported on liquid clustered tables, OPTIMIZE clusters the data on the CLUSTER BY columns)
+spark.sql(f"OPTIMIZE {database}.churn_user_features")
+display(spark.sql(f"DESCRIBE DETAIL {database}.churn_user_features").select('clusteringColumns', 'numFiles', 'sizeInBytes'))
 
 # COMMAND ----------
 
@@ -154,7 +251,11 @@ display(features)
 # COMMAND ----------
 
 from databricks import automl
-train_dataset = fs.read_table(f'{database}.churn_user_features')
+# Read the feature table once and cache it, it's used by the display and the AutoML run
+# The version is pinned so all the cells below work on the same snapshot even if the table is updated
+version = spark.sql(f"DESCRIBE HISTORY {database}.churn_user_features LIMIT 1").first().version
+train_dataset = spark.read.format('delta').option('versionAsOf', version).table(f'{database}.churn_user_features').cache()
+train_dataset.count()
 
 # COMMAND ----------
 
@@ -163,7 +264,10 @@ display(train_dataset)
 # COMMAND ----------
 
 # summary = automl.classify(train_dataset.select('gender', 'age_group', 'churn'), target_col="churn")
-summary = automl.classify(train_dataset, target_col="churn")
+# Don't let AutoML profile the primary key or timestamp columns we won't use as features
+exclude_cols = ['user_id'] + [c for c, t in train_dataset.dtypes if t == 'timestamp']
+summary = automl.classify(train_dataset, target_col="churn", exclude_cols=exclude_cols)
+train_dataset.unpersist()
 
 # COMMAND ----------
 